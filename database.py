@@ -1,20 +1,194 @@
 # database.py
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text
+from sqlalchemy import create_engine, event, text, Column, ForeignKey, Index, Integer, String, DateTime, Text
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 import datetime
+import os
 
-DATABASE_URL = "sqlite:///./chat.db"  # SQLite file-based database
+# SQLite file-based database. SQLite allows a single writer at a time, so all
+# writes share one exclusively checked-out connection while reads get their
+# own read-only pool. Reads come from request handlers, so they go through
+# aiosqlite and never block the event loop; writes already run on executor
+# threads.
+WRITE_DATABASE_URL = "sqlite:///./chat.db"
+READ_DATABASE_URL = "sqlite+aiosqlite:///file:chat.db?mode=ro&uri=true"
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# WAL lets /search readers run alongside the websocket writer; the rest trade
+# per-commit fsyncs and disk temp files for memory.
+SQLITE_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "busy_timeout=5000",
+    "cache_size=-20000",
+    "temp_store=MEMORY",
+)
+
+write_engine = create_engine(
+    WRITE_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=QueuePool,
+    pool_size=1,
+    max_overflow=0,
+)
+read_engine = create_async_engine(
+    READ_DATABASE_URL,
+    pool_size=os.cpu_count() or 1,
+)
+
+# pysqlite defers BEGIN until the first DML statement and commits around DDL,
+# so write transactions are opened explicitly instead. IMMEDIATE takes the
+# write lock up front, which also makes schema changes atomic.
+@event.listens_for(write_engine, "connect")
+def _disable_pysqlite_transactions(dbapi_conn, _):
+    dbapi_conn.isolation_level = None
+
+@event.listens_for(write_engine, "begin")
+def _begin_immediate(conn):
+    conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+@event.listens_for(write_engine, "connect")
+@event.listens_for(read_engine.sync_engine, "connect")
+def _set_pragmas(dbapi_conn, _):
+    # Runs once for every new pooled connection SQLAlchemy opens.
+    cursor = dbapi_conn.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+
+ReadSession = async_sessionmaker(autoflush=False, bind=read_engine)
 Base = declarative_base()
 
+class User(Base):
+    __tablename__ = "users"
+    id = Column(Integer, primary_key=True)
+    email = Column(String, unique=True)
+    full_name = Column(String)
+
+# Messages reference their sender by integer id, which keeps rows small and
+# lets per-user history be read straight from the (sender_id, timestamp) index.
 class Message(Base):
     __tablename__ = "messages"
     id = Column(Integer, primary_key=True, index=True)
-    sender = Column(String, index=True)
+    sender_id = Column(Integer, ForeignKey("users.id"))
     content = Column(Text)
     timestamp = Column(DateTime, default=datetime.datetime.utcnow)
+    __table_args__ = (Index("ix_msg_sender_ts", "sender_id", "timestamp"),)
+
+def upsert_user(email: str, full_name: str) -> int:
+    # Returns the user's id, creating the row on first sight of the email.
+    statement = insert(User).values(email=email, full_name=full_name)
+    statement = statement.on_conflict_do_update(
+        index_elements=[User.email], set_={"full_name": full_name}
+    ).returning(User.id)
+    with write_engine.begin() as conn:
+        return conn.execute(statement).scalar_one()
+
+# Full-text index over messages for /search. It is an external-content table,
+# so it stores only the index and the triggers keep it in sync with messages.
+SEARCH_INDEX_DDL = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content, content='messages', content_rowid='id', tokenize='unicode61'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+)
+
+def create_search_index():
+    with write_engine.begin() as conn:
+        exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'")).first()
+        for statement in SEARCH_INDEX_DDL:
+            conn.execute(text(statement))
+        if not exists:
+            # Index any messages written before the search index existed.
+            conn.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+
+# Moves a chat.db written before messages.sender_id existed onto the users
+# table. Legacy rows only recorded a display name: a name shared by exactly one
+# existing account is attributed to it, and every other name gets a user
+# without an email, since there is no way to tell which account wrote it.
+LEGACY_SENDER_DROP_SEARCH_INDEX = (
+    "DROP TRIGGER IF EXISTS messages_fts_ai",
+    "DROP TRIGGER IF EXISTS messages_fts_ad",
+    "DROP TRIGGER IF EXISTS messages_fts_au",
+    "DROP TABLE IF EXISTS messages_fts",
+)
+# Written to be safe to resume: an earlier, non-atomic version of this
+# migration could leave messages_legacy behind next to a live messages table.
+LEGACY_SENDER_COPY = (
+    """CREATE TEMP TABLE legacy_senders AS
+        SELECT DISTINCT m.sender AS sender, (
+            SELECT CASE WHEN COUNT(*) = 1 THEN MIN(u.id) END
+            FROM users u WHERE u.full_name = m.sender AND u.email IS NOT NULL
+        ) AS user_id
+        FROM messages_legacy m WHERE m.sender IS NOT NULL""",
+    """INSERT INTO users (full_name)
+        SELECT s.sender FROM legacy_senders s
+        WHERE s.user_id IS NULL
+          AND NOT EXISTS (SELECT 1 FROM users u WHERE u.full_name = s.sender AND u.email IS NULL)""",
+    """UPDATE legacy_senders SET user_id = (
+            SELECT MIN(u.id) FROM users u WHERE u.full_name = legacy_senders.sender AND u.email IS NULL
+        )
+        WHERE user_id IS NULL""",
+    # Keep legacy ids wherever they are still free...
+    """INSERT INTO messages (id, sender_id, content, timestamp)
+        SELECT m.id, s.user_id, m.content, m.timestamp
+        FROM messages_legacy m LEFT JOIN legacy_senders s ON s.sender = m.sender
+        WHERE m.id NOT IN (SELECT id FROM messages)""",
+    # ...and give fresh ids to rows whose id was taken by a newer message.
+    """INSERT INTO messages (sender_id, content, timestamp)
+        SELECT s.user_id, m.content, m.timestamp
+        FROM messages_legacy m LEFT JOIN legacy_senders s ON s.sender = m.sender
+        WHERE NOT EXISTS (
+            SELECT 1 FROM messages n
+            WHERE n.id = m.id AND n.content IS m.content AND n.timestamp IS m.timestamp
+        )
+        ORDER BY m.id""",
+    "DROP TABLE legacy_senders",
+    "DROP TABLE messages_legacy",
+)
+
+def migrate_legacy_senders():
+    # One BEGIN IMMEDIATE transaction, so a failure leaves chat.db untouched
+    # and concurrently starting workers wait for whichever migrates first.
+    with write_engine.begin() as conn:
+        tables = set(conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'")).scalars())
+        if "messages_legacy" not in tables:
+            columns = {row[1] for row in conn.execute(text("PRAGMA table_info(messages)"))}
+            if "sender" not in columns:
+                return
+        for statement in LEGACY_SENDER_DROP_SEARCH_INDEX:
+            conn.execute(text(statement))
+        if "messages_legacy" not in tables:
+            conn.execute(text("ALTER TABLE messages RENAME TO messages_legacy"))
+        # Indexes follow the table through the rename; free their names for
+        # the new messages table.
+        legacy_indexes = conn.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'messages_legacy' AND sql IS NOT NULL"
+        )).scalars().all()
+        for name in legacy_indexes:
+            conn.execute(text(f'DROP INDEX "{name}"'))
+        Base.metadata.create_all(bind=conn)
+        for statement in LEGACY_SENDER_COPY:
+            conn.execute(text(statement))
 
-Base.metadata.create_all(bind=engine)
+def init_db(known_users: dict[str, str]) -> dict[str, int]:
+    # Creating the schema through the writer also creates chat.db, which the
+    # read-only engine cannot do on its own. Known users (email -> full name)
+    # are stored before migrating so legacy history can be attributed to them;
+    # their ids are returned.
+    User.__table__.create(bind=write_engine, checkfirst=True)
+    user_ids = {email: upsert_user(email, full_name) for email, full_name in known_users.items()}
+    migrate_legacy_senders()
+    Base.metadata.create_all(bind=write_engine)
+    create_search_index()
+    return user_ids
@@ -0,0 +1,27 @@
+# export_onnx.py
+# Exports the moderation model to ONNX and quantizes it to int8. main.py picks
+# up the result from MODERATION_ONNX_DIR on its next start.
+import os
+
+from onnxruntime.quantization import QuantType, quantize_dynamic
+from optimum.onnxruntime import ORTModelForSequenceClassification
+from transformers import AutoTokenizer
+
+MODEL_NAME = "distilbert/distilbert-base-uncased-finetuned-sst-2-english"
+MODEL_REVISION = "714eb0f"
+ONNX_DIR = os.getenv("MODERATION_ONNX_DIR", "distilbert-onnx")
+
+if __name__ == "__main__":
+    model = ORTModelForSequenceClassification.from_pretrained(MODEL_NAME, revision=MODEL_REVISION, export=True)
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, revision=MODEL_REVISION)
+    model.save_pretrained(ONNX_DIR)
+    tokenizer.save_pretrained(ONNX_DIR)
+
+    # Dynamic quantization stores weights as int8 and quantizes activations on
+    # the fly, so no calibration data is needed.
+    quantize_dynamic(
+        os.path.join(ONNX_DIR, "model.onnx"),
+        os.path.join(ONNX_DIR, "model.int8.onnx"),
+        weight_type=QuantType.QInt8,
+    )
+    print(f"Quantized model written to {ONNX_DIR}/model.int8.onnx")
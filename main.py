@@ -1,31 +1,91 @@
 # main.py
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, status, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi.responses import FileResponse, RedirectResponse, Response
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
 import uvicorn
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import datetime
-from urllib.parse import parse_qs
+import functools
+import logging
+from typing import Optional
+from urllib.parse import unquote_plus
 import os
+import re
+import orjson
 
 # Database imports
-from sqlalchemy.orm import Session
-from database import SessionLocal, Message
+from sqlalchemy import insert, select, text, DateTime, String, Text
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import ReadSession, read_engine, write_engine, Message, User, init_db, upsert_user
 
 # ML imports for content moderation
-from transformers import pipeline
+from transformers import AutoTokenizer, pipeline
+try:
+    import ahocorasick
+except ImportError:  # Optional: banned words fall back to a compiled regex.
+    ahocorasick = None
+
+# Redis pub/sub for broadcasting across uvicorn workers
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
 
 # OAuth imports from Authlib
 from authlib.integrations.starlette_client import OAuth, OAuthError
 
-# Initialize the sentiment analysis pipeline with explicit PyTorch backend.
-sentiment_pipeline = pipeline(
-    "sentiment-analysis",
-    model="distilbert/distilbert-base-uncased-finetuned-sst-2-english",
-    revision="714eb0f",
-    framework="pt"
-)
+MODERATION_MODEL = "distilbert/distilbert-base-uncased-finetuned-sst-2-english"
+MODERATION_MODEL_REVISION = "714eb0f"
+# Directory produced by export_onnx.py.
+MODERATION_ONNX_DIR = os.getenv("MODERATION_ONNX_DIR", "distilbert-onnx")
+MODERATION_ONNX_FILE = "model.int8.onnx"
+
+def load_sentiment_pipeline():
+    # Prefer the int8-quantized ONNX export; it is several times faster on CPU
+    # than the FP32 PyTorch model.
+    if os.path.exists(os.path.join(MODERATION_ONNX_DIR, MODERATION_ONNX_FILE)):
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForSequenceClassification
+
+        sess_options = onnxruntime.SessionOptions()
+        sess_options.intra_op_num_threads = os.cpu_count() or 1
+        ort_model = ORTModelForSequenceClassification.from_pretrained(
+            MODERATION_ONNX_DIR,
+            file_name=MODERATION_ONNX_FILE,
+            provider="CPUExecutionProvider",
+            session_options=sess_options,
+        )
+        tokenizer = AutoTokenizer.from_pretrained(MODERATION_ONNX_DIR)
+        return pipeline("sentiment-analysis", model=ort_model, tokenizer=tokenizer)
+
+    # Fall back to the PyTorch backend until export_onnx.py has been run.
+    import torch
+
+    torch.set_num_threads(os.cpu_count() or 1)
+    torch_pipeline = pipeline(
+        "sentiment-analysis",
+        model=MODERATION_MODEL,
+        revision=MODERATION_MODEL_REVISION,
+        framework="pt"
+    )
+    # Pipelines run forward passes under torch.no_grad; inference_mode also
+    # skips version-counter and view tracking on every tensor.
+    torch_pipeline.get_inference_context = lambda: torch.inference_mode
+    return torch_pipeline
+
+sentiment_pipeline = load_sentiment_pipeline()
+
+# All inference runs on one dedicated thread, off the event loop. The runtimes
+# already parallelize each forward pass across cores, so more threads would
+# only contend for them.
+inference_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="moderation")
+
+# Database writes likewise run one at a time on their own thread, so each
+# transaction has the single write connection to itself.
+write_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Campus Connect")
 
@@ -48,13 +108,14 @@ app.add_middleware(
 async def read_index():
     return FileResponse("index.html")
 
-# Dependency: Get a database session.
-def get_db():
-    db = SessionLocal()
-    try:
+# Dependency: Get a read-only database session.
+async def get_db():
+    async with ReadSession() as db:
         yield db
-    finally:
-        db.close()
+
+@app.on_event("shutdown")
+async def close_read_engine():
+    await read_engine.dispose()
 
 # ---------------------------
 # Simplified User Authentication (HTTP endpoints)
@@ -73,14 +134,36 @@ fake_users_db = {
     # New Google users will be added dynamically.
 }
 
+# Every known user gets a row in the users table; its id is what messages store.
+user_ids = init_db({email: user["full_name"] for email, user in fake_users_db.items()})
+for email, user in fake_users_db.items():
+    user["id"] = user_ids[email]
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-def fake_decode_token(token: str):
+# Cached per token. Unknown tokens raise instead of returning None, so misses are
+# never cached and a user added to fake_users_db later is still found.
+@functools.lru_cache(maxsize=2048)
+def _decode(token: str):
     # For this demo, the token is simply the user's email.
-    return fake_users_db.get(token)
+    return fake_users_db[token]
+
+async def fake_decode_token(token: str):
+    try:
+        return _decode(token)
+    except KeyError:
+        pass
+    # With several workers, a Google user may have signed in through another
+    # process; the users table is shared, so pick them up from there.
+    async with ReadSession() as db:
+        row = (await db.execute(select(User.id, User.full_name).where(User.email == token))).first()
+    if row is None:
+        return None
+    fake_users_db.setdefault(token, {"id": row.id, "username": token, "full_name": row.full_name, "password": None})
+    return _decode(token)
 
 async def get_current_user(token: str = Depends(oauth2_scheme)):
-    user = fake_decode_token(token)
+    user = await fake_decode_token(token)
     if not user:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
     return user
@@ -133,7 +216,8 @@ async def auth_google_callback(request: Request):
     if not email.endswith("@srm.edu.in"):
         raise HTTPException(status_code=400, detail="Only SRM email accounts are allowed.")
     if email not in fake_users_db:
-        fake_users_db[email] = {"username": email, "full_name": full_name, "password": None}
+        user_id = await asyncio.get_running_loop().run_in_executor(write_pool, upsert_user, email, full_name)
+        fake_users_db[email] = {"id": user_id, "username": email, "full_name": full_name, "password": None}
     response = RedirectResponse(url=f"/?token={email}")
     response.set_cookie(key="access_token", value=email)
     return response
@@ -146,107 +230,363 @@ class ChatMessage(BaseModel):
     content: str
     timestamp: str
 
-# In-memory storage for chat messages (optional).
-chat_messages = []
-
 # ---------------------------
 # Enhanced Content Moderation using ML
 # ---------------------------
-def moderate_message(content: str) -> bool:
-    banned_words = ["spam", "scam", "advertisement"]
-    lower_content = content.lower()
-    for word in banned_words:
-        if word in lower_content:
+BANNED_WORDS = ["spam", "scam", "advertisement"]
+
+# Either way, every banned word is matched in a single pass over the message.
+if ahocorasick is not None:
+    banned_automaton = ahocorasick.Automaton()
+    for word in BANNED_WORDS:
+        banned_automaton.add_word(word, word)
+    banned_automaton.make_automaton()
+
+    def contains_banned_word(content: str) -> bool:
+        for _ in banned_automaton.iter(content.lower()):
             return True
-    result = sentiment_pipeline(content)
-    sentiment = result[0]
-    if sentiment["label"] == "NEGATIVE" and sentiment["score"] > 0.95:
+        return False
+else:
+    banned_pattern = re.compile("|".join(map(re.escape, BANNED_WORDS)), re.IGNORECASE)
+
+    def contains_banned_word(content: str) -> bool:
+        return banned_pattern.search(content) is not None
+
+MODERATION_MAX_BATCH = 32
+MODERATION_BATCH_WINDOW = 0.005  # Seconds to wait for more messages to join a batch.
+
+# Created at startup so the queue belongs to the server's event loop.
+moderation_queue: asyncio.Queue = None
+
+def is_negative(sentiment: dict) -> bool:
+    return sentiment["label"] == "NEGATIVE" and sentiment["score"] > 0.95
+
+async def moderation_worker():
+    # Messages from every connected socket are coalesced into one pipeline call,
+    # so the model runs a single batched forward pass instead of one per message.
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await moderation_queue.get()]
+        deadline = loop.time() + MODERATION_BATCH_WINDOW
+        while len(batch) < MODERATION_MAX_BATCH:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(moderation_queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+
+        texts = [content for content, _ in batch]
+        try:
+            results = await loop.run_in_executor(
+                inference_pool,
+                functools.partial(sentiment_pipeline, texts, batch_size=len(texts), truncation=True),
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+        for (_, future), sentiment in zip(batch, results):
+            if not future.done():
+                future.set_result(is_negative(sentiment))
+
+async def moderate_message(content: str) -> bool:
+    # Obvious spam is rejected here without ever reaching the model.
+    if contains_banned_word(content):
         return True
-    return False
+    future = asyncio.get_running_loop().create_future()
+    await moderation_queue.put((content, future))
+    return await future
+
+def warm_up_pipeline():
+    # The first forward pass pays for lazy kernel, allocator and session setup;
+    # run it on the inference thread before any real message is waiting on it.
+    sentiment_pipeline(["warm up"] * MODERATION_MAX_BATCH, batch_size=MODERATION_MAX_BATCH, truncation=True)
+
+@app.on_event("startup")
+async def start_moderation_worker():
+    global moderation_queue
+    await asyncio.get_running_loop().run_in_executor(inference_pool, warm_up_pipeline)
+    moderation_queue = asyncio.Queue()
+    app.state.moderation_task = asyncio.create_task(moderation_worker())
+
+@app.on_event("shutdown")
+async def stop_moderation_worker():
+    app.state.moderation_task.cancel()
+    inference_pool.shutdown(wait=False, cancel_futures=True)
+
+# ---------------------------
+# Batched Message Persistence
+# ---------------------------
+INSERT_FLUSH_INTERVAL = 0.02  # Seconds to let a batch fill before committing it.
+INSERT_MAX_BATCH = 500
+
+# Created at startup so the queue belongs to the server's event loop.
+insert_queue: asyncio.Queue = None
+
+# Queued at shutdown; the flusher writes everything ahead of it, then exits.
+FLUSHER_STOP = object()
+
+def write_messages(rows: list[dict]):
+    # One transaction (and one WAL commit) for the whole batch.
+    with write_engine.begin() as conn:
+        conn.execute(insert(Message), rows)
+
+async def message_flusher():
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        row = await insert_queue.get()
+        if row is FLUSHER_STOP:
+            break
+        batch = [row]
+        await asyncio.sleep(INSERT_FLUSH_INTERVAL)
+        while not insert_queue.empty() and len(batch) < INSERT_MAX_BATCH:
+            row = insert_queue.get_nowait()
+            if row is FLUSHER_STOP:
+                stopping = True
+                break
+            batch.append(row)
+        try:
+            await loop.run_in_executor(write_pool, write_messages, batch)
+        except Exception:
+            # Keep flushing; a dead flusher would let the queue grow without bound.
+            logger.exception("Failed to persist %d chat messages", len(batch))
+
+@app.on_event("startup")
+async def start_message_flusher():
+    global insert_queue
+    insert_queue = asyncio.Queue()
+    app.state.flusher_task = asyncio.create_task(message_flusher())
+
+@app.on_event("shutdown")
+async def stop_message_flusher():
+    # Let the flusher write its in-flight batch and everything queued behind
+    # it, rather than cancelling it mid-batch.
+    await insert_queue.put(FLUSHER_STOP)
+    await app.state.flusher_task
+    write_pool.shutdown()
 
 # ---------------------------
 # WebSocket Connection Manager
 # ---------------------------
+# Naive UTC datetimes are serialized as ISO 8601 with a trailing "Z".
+JSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z
+
+SEND_QUEUE_SIZE = 256  # Payloads a client may fall behind by before it is dropped.
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: list[WebSocket] = []
+        # Every socket has its own outgoing queue drained by a dedicated writer
+        # task, so a slow client only ever delays itself.
+        self.active_connections: dict[WebSocket, asyncio.Queue] = {}
+        self.writers: dict[WebSocket, asyncio.Task] = {}
+        self.closing: set[asyncio.Task] = set()
     
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.active_connections[websocket] = queue
+        self.writers[websocket] = asyncio.create_task(self._writer_loop(websocket, queue))
     
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
+        self.active_connections.pop(websocket, None)
+        writer = self.writers.pop(websocket, None)
+        if writer is not None and writer is not asyncio.current_task():
+            writer.cancel()
+    
+    async def _writer_loop(self, websocket: WebSocket, queue: asyncio.Queue):
+        try:
+            while True:
+                batch = [await queue.get()]
+                while not queue.empty():
+                    batch.append(queue.get_nowait())
+                # Merge whatever queued up while the previous send was in flight
+                # into one frame; the client accepts a JSON array of messages.
+                if len(batch) == 1:
+                    await websocket.send_text(batch[0])
+                else:
+                    await websocket.send_text("[" + ",".join(batch) + "]")
+        except Exception:
+            self.disconnect(websocket)
+    
+    def _enqueue(self, websocket: WebSocket, payload: str):
+        queue = self.active_connections.get(websocket)
+        if queue is None:
+            return
+        try:
+            queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            # The client cannot keep up; drop it instead of buffering without bound.
+            self.disconnect(websocket)
+            task = asyncio.create_task(websocket.close(code=status.WS_1013_TRY_AGAIN_LATER))
+            self.closing.add(task)
+            task.add_done_callback(self.closing.discard)
+    
+    def send_personal_message(self, message: dict, websocket: WebSocket):
+        self._enqueue(websocket, orjson.dumps(message, option=JSON_OPTIONS).decode())
+    
+    def local_broadcast(self, payload: str):
+        # Fans an already-serialized message out to this worker's sockets.
+        for websocket in list(self.active_connections):
+            self._enqueue(websocket, payload)
     
     async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            await connection.send_json(message)
+        # Serialize once for every recipient. The browser client parses text
+        # frames, so the encoded payload is sent as text rather than bytes.
+        self.local_broadcast(orjson.dumps(message, option=JSON_OPTIONS).decode())
 
 manager = ConnectionManager()
 
+# ---------------------------
+# Cross-Worker Fanout via Redis Pub/Sub
+# ---------------------------
+# With REDIS_URL set, approved messages are published to Redis and every worker
+# relays them to its own sockets. Without it, broadcasts stay in-process.
+REDIS_URL = os.getenv("REDIS_URL")
+CHAT_CHANNEL = "campus-connect:chat"
+REDIS_RETRY_DELAY = 1.0  # Seconds between subscriber reconnect attempts.
+
+redis_client = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+
+async def publish_message(message: dict):
+    if redis_client is None:
+        await manager.broadcast(message)
+        return
+    try:
+        await redis_client.publish(CHAT_CHANNEL, orjson.dumps(message, option=JSON_OPTIONS))
+    except RedisError:
+        # Still reach this worker's clients rather than dropping the sender.
+        logger.exception("Failed to publish chat message, broadcasting locally")
+        await manager.broadcast(message)
+
+async def redis_subscriber():
+    while True:
+        try:
+            async with redis_client.pubsub() as pubsub:
+                await pubsub.subscribe(CHAT_CHANNEL)
+                async for item in pubsub.listen():
+                    if item["type"] != "message":
+                        continue
+                    try:
+                        manager.local_broadcast(item["data"].decode())
+                    except Exception:
+                        # One bad payload must not stop delivery of the rest.
+                        logger.exception("Dropped undeliverable message from %s", CHAT_CHANNEL)
+        except RedisError:
+            logger.exception("Lost Redis subscription, retrying in %.0fs", REDIS_RETRY_DELAY)
+            await asyncio.sleep(REDIS_RETRY_DELAY)
+
+def log_subscriber_exit(task: asyncio.Task):
+    if task.cancelled():
+        return
+    logger.error("Redis subscriber stopped; this worker no longer receives chat messages",
+                 exc_info=task.exception())
+
+@app.on_event("startup")
+async def start_redis_subscriber():
+    if redis_client is not None:
+        app.state.subscriber_task = asyncio.create_task(redis_subscriber())
+        app.state.subscriber_task.add_done_callback(log_subscriber_exit)
+
+@app.on_event("shutdown")
+async def stop_redis_subscriber():
+    if redis_client is not None:
+        app.state.subscriber_task.cancel()
+        await redis_client.aclose()
+
 # ---------------------------
 # WebSocket Endpoint for Real-Time Chat
 # ---------------------------
+def query_param(query_string: bytes, name: bytes) -> Optional[str]:
+    # Pulls a single parameter out of the raw query string without building
+    # the full dict of lists that parse_qs would.
+    for pair in query_string.split(b"&"):
+        key, _, value = pair.partition(b"=")
+        if key == name:
+            if b"%" in value or b"+" in value:
+                return unquote_plus(value.decode())
+            return value.decode()
+    return None
+
 @app.websocket("/ws/chat")
 async def websocket_endpoint(websocket: WebSocket):
-    query_params = parse_qs(websocket.scope["query_string"].decode())
-    token_list = query_params.get("token")
-    if not token_list:
+    token = query_param(websocket.scope["query_string"], b"token")
+    if not token:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return
-    token = token_list[0]
-    current_user = fake_decode_token(token)
+    current_user = await fake_decode_token(token)
     if not current_user:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return
 
     await manager.connect(websocket)
-    db: Session = SessionLocal()  # Create a database session.
     try:
         while True:
-            data = await websocket.receive_json()
+            data = orjson.loads(await websocket.receive_text())
             sender = current_user["full_name"]
             content = data.get("content", "")
             timestamp = datetime.datetime.utcnow()
             
-            if moderate_message(content):
-                await websocket.send_json({"error": "Message flagged as inappropriate."})
+            if await moderate_message(content):
+                manager.send_personal_message({"error": "Message flagged as inappropriate."}, websocket)
                 continue
 
             message_entry = {
                 "sender": sender,
                 "content": content,
-                "timestamp": timestamp.isoformat() + "Z"
+                "timestamp": timestamp
             }
-            chat_messages.append(message_entry)
-            
-            db_message = Message(sender=sender, content=content, timestamp=timestamp)
-            db.add(db_message)
-            db.commit()
-            db.refresh(db_message)
-            
-            await manager.broadcast(message_entry)
+            await insert_queue.put({"sender_id": current_user["id"], "content": content, "timestamp": timestamp})
+
+            await publish_message(message_entry)
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
+        pass
     finally:
-        db.close()
+        manager.disconnect(websocket)
 
 # ---------------------------
 # REST API Endpoint for Searching Chat History (Database-backed)
 # ---------------------------
+SEARCH_QUERY = text("""
+    SELECT u.full_name AS sender, m.content, m.timestamp
+    FROM messages m
+    JOIN messages_fts f ON f.rowid = m.id
+    LEFT JOIN users u ON u.id = m.sender_id
+    WHERE messages_fts MATCH :q
+    ORDER BY m.id
+""").columns(sender=String, content=Text, timestamp=DateTime)
+
+def fts_query(keyword: str) -> str:
+    # Quote the keyword so FTS5 operators in user input are matched literally,
+    # and prefix-match the last word so partial words still find messages.
+    phrase = keyword.replace('"', '""')
+    return f'content : "{phrase}"*'
+
 @app.get("/search")
-async def search_messages(keyword: str, current_user: dict = Depends(get_current_user), db: Session = Depends(get_db)):
-    results = db.query(Message).filter(Message.content.ilike(f"%{keyword}%")).all()
-    formatted_results = [{
-        "sender": msg.sender,
-        "content": msg.content,
-        "timestamp": msg.timestamp.isoformat() + "Z"
-    } for msg in results]
-    return {"results": formatted_results}
+async def search_messages(keyword: str, current_user: dict = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    if not keyword.strip():
+        return {"results": []}
+    rows = (await db.execute(SEARCH_QUERY, {"q": fts_query(keyword)})).tuples().all()
+    results = [{"sender": sender, "content": content, "timestamp": timestamp} for sender, content, timestamp in rows]
+    # orjson formats the timestamps natively, the same way websocket messages are.
+    body = orjson.dumps({"results": results}, option=JSON_OPTIONS)
+    return Response(content=body, media_type="application/json")
 
 # ---------------------------
 # Run the Application
 # ---------------------------
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+        # Without Redis, broadcasts only reach clients on the same worker, so
+        # default to a single process unless fanout goes through pub/sub.
+        workers=int(os.getenv("WORKERS", os.cpu_count() if REDIS_URL else 1)),
+    )